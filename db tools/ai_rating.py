@@ -1,165 +1,340 @@
-import json
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
 import re
-import time
+import tempfile
 from typing import Optional
 
+import httpx
 import numpy as np
+import orjson
 import pandas as pd
-from urllib import request, error
-
-
-def _openai_chat_json(api_key: str, system_prompt: str, user_prompt: str) -> dict:
-    data = {
-        "model": "gpt-4o-mini",
-        "messages": [
-            {"role": "system", "content": system_prompt},
-            {"role": "user", "content": user_prompt},
-        ],
-        "temperature": 0.2,
-    }
-    req = request.Request(
-        url="https://api.openai.com/v1/chat/completions",
-        data=json.dumps(data).encode("utf-8"),
-        headers={
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-        },
-        method="POST",
-    )
-    try:
-        with request.urlopen(req, timeout=60) as resp:
-            body = resp.read().decode("utf-8")
-    except error.HTTPError as e:
+from aiolimiter import AsyncLimiter
+from tqdm import tqdm
+
+from ai_rating_core import (
+    IS_GROCERY_BONUS,
+    IS_HEALTHY_BONUS,
+    IS_RESTAURANT_BONUS,
+    _openai_chat_json,
+    _parse_bool,
+    openai_headers,
+)
+
+
+async def _chat_json_with_retry(client, system, user, limiters, max_retries: int = 5):
+    """Call _openai_chat_json under the request/token limiters, retrying
+    429/5xx/timeouts with exponential backoff instead of giving up immediately."""
+    request_limiter, token_limiter = limiters
+    # Rough token estimate: ~4 characters per token
+    est_tokens = (len(system) + len(user)) // 4
+    wait = 1.0
+    for attempt in range(max_retries + 1):
+        await request_limiter.acquire()
+        await token_limiter.acquire(est_tokens)
         try:
-            body = e.read().decode("utf-8")
-        except Exception:
-            body = "{}"
-        raise RuntimeError(f"OpenAI HTTP error: {e.code} {body}")
-    except Exception as e:
-        raise RuntimeError(f"OpenAI request failed: {e}")
+            return await _openai_chat_json(client, system, user)
+        except RuntimeError as e:
+            status = getattr(e, "status", None)
+            retryable = status is None or status == 429 or status >= 500
+            if attempt >= max_retries or not retryable:
+                raise
+            await asyncio.sleep(wait)
+            wait *= 2
+
+
+def _normalize_name(value) -> str:
+    # Upper-case and collapse whitespace so chain branches share one cache key
+    return re.sub(r"\s+", " ", str(value)).strip().upper()
 
+
+def _load_ai_cache(path: str) -> dict:
     try:
-        j = json.loads(body)
-        content = j.get("choices", [{}])[0].get("message", {}).get("content", "")
-        try:
-            return json.loads(content)
-        except Exception:
-            m = re.search(r"\{[\s\S]*\}", content)
-            if m:
-                return json.loads(m.group(0))
-            return {}
+        with open(path, "rb") as fh:
+            cache = orjson.loads(fh.read())
+        return cache if isinstance(cache, dict) else {}
+    except FileNotFoundError:
+        return {}
     except Exception:
         return {}
 
 
-def _parse_bool(value) -> bool:
+def _save_ai_cache(path: str, cache: dict) -> None:
+    try:
+        with open(path, "wb") as fh:
+            fh.write(orjson.dumps(cache))
+    except Exception:
+        pass
+
+
+def _atomic_to_csv(df: pd.DataFrame, path: str) -> None:
+    # Write to a temp file in the same directory, then rename over the target,
+    # so a crash mid-write never leaves a truncated CSV behind
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    os.close(fd)
     try:
-        if value is None:
-            return False
-        if isinstance(value, (int, float)):
-            return bool(int(value))
-        s = str(value).strip().lower()
-        return s in {"1", "true", "yes", "y", "t"}
+        df.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, path)
     except Exception:
-        return False
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+async def _rate_batch(sem, client, system, keys, user, limiters):
+    """Rate one batch of unique keys in a single chat call using a pre-built
+    user message, returning a list of (key, raw entry dict or None on failure)."""
+    async with sem:
+        try:
+            j = await _chat_json_with_retry(client, system, user, limiters)
+            entries = j.get("results", [])
+            by_pos = {e.get("index"): e for e in entries if isinstance(e, dict)}
+            return [(key, by_pos.get(k)) for k, key in enumerate(keys)]
+        except Exception:
+            return [(key, None) for key in keys]
+
+
+async def _rate_all(unique_rows, api_key, system, concurrency, batch_size, rpm, tpm,
+                    flush_every=0, on_flush=None, progress=True):
+    sem = asyncio.Semaphore(concurrency)
+    # Token-bucket limiters for RPM and TPM, composed with the semaphore so a
+    # retry storm can't burn the whole request budget at once
+    limiters = (AsyncLimiter(rpm, 60), AsyncLimiter(tpm, 60))
+    # One pooled HTTP/2 client for the whole run: concurrent calls multiplex
+    # over a shared TLS connection instead of opening a socket per request
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+    async with httpx.AsyncClient(
+        http2=True, limits=limits, timeout=60.0, headers=openai_headers(api_key)
+    ) as client:
+        total_unique = len(unique_rows)
+        # Serialize every batch's user message up front, tagging payloads with
+        # their batch position, so no JSON encoding happens on the event loop
+        # once requests are in flight
+        batches = []
+        for start in range(0, total_unique, batch_size):
+            chunk = unique_rows[start:start + batch_size]
+            keys = [key for key, _ in chunk]
+            payloads = [dict(payload, index=k) for k, (_, payload) in enumerate(chunk)]
+            batches.append((keys, f"Rate these stores: {orjson.dumps(payloads).decode()}"))
+        tasks = [
+            _rate_batch(sem, client, system, keys, user, limiters)
+            for keys, user in batches
+        ]
+        entries = {}
+        done_since_flush = 0
+        # tqdm updates one in-place line instead of printing per batch, which
+        # would serialize the event loop on stdout under high concurrency
+        with tqdm(total=total_unique, unit="store", desc="AI rating", disable=not progress) as pbar:
+            for coro in asyncio.as_completed(tasks):
+                pairs = await coro
+                for key, entry in pairs:
+                    entries[key] = entry
+                    done_since_flush += 1
+                pbar.update(len(pairs))
+                if on_flush is not None and flush_every > 0 and done_since_flush >= flush_every:
+                    on_flush(dict(entries))
+                    done_since_flush = 0
+        return entries
+
+
+def _rate_shard(shard, api_key, system, concurrency, batch_size, rpm, tpm):
+    """Worker entry point: rate one shard of unique keys in its own event loop
+    (and its own HTTP/2 client) inside a pool process."""
+    return asyncio.run(
+        _rate_all(shard, api_key, system, concurrency, batch_size, rpm, tpm, progress=False)
+    )
 
 
 def rate_stores_with_ai(
     df: pd.DataFrame,
     api_key: str,
-    delay_seconds: float = 0.15,
+    concurrency: int = 50,
+    batch_size: int = 20,
+    rpm: int = 500,
+    tpm: int = 200_000,
     limit: Optional[int] = None,
+    cache_path: str = "ai_cache.json",
+    output_csv: Optional[str] = None,
+    flush_every: int = 200,
+    workers: int = 0,
 ) -> pd.DataFrame:
-    total_stores = len(df)
-    # Initialize health rating columns
-    if "AI_Health_Score" not in df.columns:
-        df["AI_Health_Score"] = np.nan
+    # Initialize score columns as nullable Int8: scores are 1-10 integers, so
+    # a float64 NaN column wastes memory and unrated rows should stay blank
+    for score_col in ("AI_Health_Score", "AI_Economy_Score"):
+        if score_col not in df.columns:
+            df[score_col] = pd.Series(pd.NA, index=df.index, dtype="Int8")
+        else:
+            df[score_col] = pd.to_numeric(df[score_col], errors="coerce").astype("Int8")
+
+    # Initialize reason columns
     if "AI_Health_Reason" not in df.columns:
         df["AI_Health_Reason"] = ""
-    
-    # Initialize economy/pricing rating columns
-    if "AI_Economy_Score" not in df.columns:
-        df["AI_Economy_Score"] = np.nan
     if "AI_Economy_Reason" not in df.columns:
         df["AI_Economy_Reason"] = ""
 
+    # Kept short: this prompt is re-sent with every batch, so its tokens are
+    # the largest fixed cost per request
     system = (
-        "You are rating food retail locations on two separate scales for SNAP users:\n\n"
-        "1. HEALTH RATING (1-10 scale):\n"
-        "- 10 = excellent access to healthy, fresh foods (abundant produce, whole foods, organic options)\n"
-        "- 1 = very poor access to healthy foods (mostly processed, limited fresh options)\n"
-        "Consider: fresh produce availability, whole foods vs ultra-processed foods, organic/natural options, store type hierarchy (grocery > super store > convenience > restaurant), store name indicators of health focus, variety of healthy choices\n\n"
-        "2. ECONOMY/PRICING RATING (1-5 scale):\n"
-        "- 1 = very affordable, excellent value for money (low prices, large portions, bulk options)\n"
-        "- 5 = very expensive, poor value for money (high prices, small portions)\n"
-        "Consider: price per serving, portion sizes, bulk purchase options, sales/discounts, SNAP benefit stretch, comparison to average market prices, value for money spent\n\n"
-        "IMPORTANT: Provide specific, actionable reasons. Focus on concrete details like 'abundant fresh vegetables' or 'high prices for small portions' rather than vague statements.\n\n"
-        "Output strict JSON: {\"health_score\": <integer 1-10>, \"health_reason\": \"specific reason (max 60 words)\", \"economy_score\": <integer 1-5>, \"economy_reason\": \"specific reason (max 60 words)\"}"
+        "Rate every store in the input JSON array for SNAP users.\n"
+        "health_score: 1-10 access to healthy, fresh food (10 = excellent, 1 = very poor).\n"
+        "economy_score: 1-5 value for money (1 = very affordable, 5 = very expensive).\n"
+        "Reasons: specific and concrete, max 60 words each.\n"
+        "Output strict JSON: {\"results\": [{\"index\": <index from input>, \"health_score\": <int>, \"health_reason\": \"...\", \"economy_score\": <int>, \"economy_reason\": \"...\"}, ...]}"
     )
 
-    iterable = df.iterrows()
+    # Only rate rows that don't already have a valid score (1-10), computed as
+    # one mask instead of re-checking per row inside the loop; on a resumed run
+    # this skips everything already persisted to the output CSV
+    needs_rating = ~pd.to_numeric(df["AI_Health_Score"], errors="coerce").between(1, 10).fillna(False)
+    to_rate = df[needs_rating]
     if isinstance(limit, int) and limit > 0:
-        iterable = list(df.head(limit).iterrows())
-
-    for i, row in iterable:
-        isHealthy = _parse_bool(row.get("Is_Healthy_Store"))
-
-        payload = {
-            "name": row.get("Store_Name", ""),
-            "address": row.get("Store_Street_Address", ""),
-            "city": row.get("City", ""),
-            "zip": row.get("Zip_Code", ""),
-            "county": row.get("County", ""),
-            "storeType": row.get("Store_Type", ""),
-        }
-
-        user = f"Rate this store: {json.dumps(payload, ensure_ascii=False)}"
-
-        try:
-            j = _openai_chat_json(api_key, system, user)
-            
-            # Process health rating
-            health_score = j.get("health_score")
-            if isHealthy and isinstance(health_score, (int, float)):
-                health_score += IS_HEALTHY_BONUS
-            health_reason = j.get("health_reason", "")
-            
-            # Process economy rating
-            economy_score = j.get("economy_score")
-            if row.get("Store_Type") == "Restaurant Meals Program":
-                economy_score += IS_RESTAURANT_BONUS
-            elif row.get("Store_Type") == "Grocery Store":
-                economy_score += IS_GROCERY_BONUS
-            economy_reason = j.get("economy_reason", "")
-            
-            # Validate and set health score
+        to_rate = to_rate.head(limit)
+
+    # Pull each column out as a numpy array once, then build payloads with
+    # plain indexing -- much cheaper than iterrows materializing a Series per row
+    n = len(to_rate)
+    idx = to_rate.index.to_numpy()
+
+    def _col(name: str) -> np.ndarray:
+        if name in to_rate.columns:
+            return to_rate[name].to_numpy()
+        return np.full(n, "", dtype=object)
+
+    names = _col("Store_Name")
+    addresses = _col("Store_Street_Address")
+    cities = _col("City")
+    zips = _col("Zip_Code")
+    counties = _col("County")
+    store_types = _col("Store_Type")
+    healthy_flags = _col("Is_Healthy_Store")
+
+    # Dedupe by (normalized name, store type): chain branches share one rating.
+    # Only keys missing from the disk cache are sent to the API.
+    cache = _load_ai_cache(cache_path)
+    row_keys = [f"{_normalize_name(names[k])}|{store_types[k]}" for k in range(n)]
+    pending = {}
+    for k in range(n):
+        key = row_keys[k]
+        if key not in cache and key not in pending:
+            pending[key] = {
+                "name": names[k],
+                "address": addresses[k],
+                "city": cities[k],
+                "zip": zips[k],
+                "county": counties[k],
+                "storeType": store_types[k],
+            }
+
+    # Per-row bonus vectors, computed once for the whole run rather than on
+    # every checkpoint broadcast
+    health_bonus = np.where(
+        [_parse_bool(v) for v in healthy_flags], IS_HEALTHY_BONUS, 0
+    ).astype(np.int8)
+    economy_bonus = np.where(
+        store_types == "Restaurant Meals Program", IS_RESTAURANT_BONUS,
+        np.where(store_types == "Grocery Store", IS_GROCERY_BONUS, 0),
+    ).astype(np.int8)
+
+    # Broadcast each unique rating back to every matching row, applying the
+    # per-row bonuses at broadcast time so cached entries stay raw. Rows whose
+    # key is still pending are only filled with placeholders on the final pass.
+    def _broadcast(fill_missing: bool) -> None:
+        # Gather raw scores/reasons per row; NaN marks an invalid/missing score
+        raw_health = np.full(n, np.nan, dtype=np.float32)
+        raw_economy = np.full(n, np.nan, dtype=np.float32)
+        health_reasons = np.full(n, None, dtype=object)
+        economy_reasons = np.full(n, None, dtype=object)
+        have = np.zeros(n, dtype=bool)
+        for k in range(n):
+            entry = cache.get(row_keys[k])
+            if entry is None:
+                continue
+            have[k] = True
+            health_score = entry.get("health_score")
             if isinstance(health_score, (int, float)):
-                health_score_int = int(max(1, min(10, round(health_score))))
-                df.at[i, "AI_Health_Score"] = health_score_int
-                df.at[i, "AI_Health_Reason"] = str(health_reason)[:240]
-            else:
-                df.at[i, "AI_Health_Score"] = 5
-                df.at[i, "AI_Health_Reason"] = "No AI health reason provided"
-            
-            # Validate and set economy score
+                raw_health[k] = health_score
+                health_reasons[k] = str(entry.get("health_reason", ""))[:240]
+            economy_score = entry.get("economy_score")
             if isinstance(economy_score, (int, float)):
-                economy_score_int = int(max(1, min(5, round(economy_score))))
-                df.at[i, "AI_Economy_Score"] = economy_score_int
-                df.at[i, "AI_Economy_Reason"] = str(economy_reason)[:240]
-            else:
-                df.at[i, "AI_Economy_Score"] = 3
-                df.at[i, "AI_Economy_Reason"] = "No AI economy reason provided"
-            
-            print(f"Finished: {i} | {round((i/total_stores)*100, 2)}%")
-                
-        except Exception:
-            df.at[i, "AI_Health_Score"] = 5
-            df.at[i, "AI_Health_Reason"] = "AI health rating unavailable"
-            df.at[i, "AI_Economy_Score"] = 3
-            df.at[i, "AI_Economy_Reason"] = "AI economy rating unavailable"
-
-        time.sleep(delay_seconds)
-
+                raw_economy[k] = economy_score
+                economy_reasons[k] = str(entry.get("economy_reason", ""))[:240]
+
+        # One SIMD-backed round/clip pass instead of N Python max/min/round/int calls
+        health = np.clip(np.rint(raw_health + health_bonus), 1, 10)
+        health = np.where(np.isnan(health), 5, health).astype(np.int8)
+        economy = np.clip(np.rint(raw_economy + economy_bonus), 1, 5)
+        economy = np.where(np.isnan(economy), 3, economy).astype(np.int8)
+
+        # Default reasons: rated-but-invalid vs never-rated rows
+        health_reasons = np.where(
+            health_reasons == None,  # noqa: E711 -- elementwise None check
+            np.where(have, "No AI health reason provided", "AI health rating unavailable"),
+            health_reasons,
+        )
+        economy_reasons = np.where(
+            economy_reasons == None,  # noqa: E711
+            np.where(have, "No AI economy reason provided", "AI economy rating unavailable"),
+            economy_reasons,
+        )
+
+        write = np.ones(n, dtype=bool) if fill_missing else have
+        if not write.any():
+            return
+        idx_array = idx[write]
+        df.loc[idx_array, "AI_Health_Score"] = health[write]
+        df.loc[idx_array, "AI_Health_Reason"] = health_reasons[write]
+        df.loc[idx_array, "AI_Economy_Score"] = economy[write]
+        df.loc[idx_array, "AI_Economy_Reason"] = economy_reasons[write]
+
+    def _merge_entries(entries: dict) -> None:
+        for key, entry in entries.items():
+            if entry is not None:
+                cache[key] = entry
+
+    # Periodic checkpoint: persist the cache and the partially-rated CSV so a
+    # crash or rate-limit abort mid-run doesn't lose (or re-spend) anything
+    def _flush(partial_entries: dict) -> None:
+        _merge_entries(partial_entries)
+        _save_ai_cache(cache_path, cache)
+        _broadcast(fill_missing=False)
+        if output_csv:
+            _atomic_to_csv(df, output_csv)
+
+    if pending:
+        unique_rows = list(pending.items())
+        nproc = workers if workers > 0 else (os.cpu_count() or 1)
+        if nproc <= 1 or len(unique_rows) <= batch_size * nproc:
+            entries = asyncio.run(
+                _rate_all(unique_rows, api_key, system, concurrency, batch_size, rpm, tpm,
+                          flush_every=flush_every, on_flush=_flush)
+            )
+            _merge_entries(entries)
+            _save_ai_cache(cache_path, cache)
+        else:
+            # Shard the unique keys round-robin across worker processes, each
+            # running its own event loop with a slice of the rate budget, so
+            # JSON/pandas CPU work scales past one core. Fork context: this
+            # module runs work at import time, so a respawning start method
+            # would re-execute the whole script in every worker.
+            shards = [unique_rows[w::nproc] for w in range(nproc)]
+            ctx = multiprocessing.get_context("fork")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=nproc, mp_context=ctx) as pool:
+                futures = [
+                    pool.submit(_rate_shard, shard, api_key, system,
+                                max(1, concurrency // nproc), batch_size,
+                                max(1, rpm // nproc), max(1, tpm // nproc))
+                    for shard in shards if shard
+                ]
+                with tqdm(total=len(futures), unit="shard", desc="AI rating") as pbar:
+                    for fut in concurrent.futures.as_completed(futures):
+                        # _flush merges, saves the cache, and checkpoints the CSV
+                        _flush(fut.result())
+                        pbar.update(1)
+
+    _broadcast(fill_missing=True)
     return df
 
 def print_score_distributions(rated):
@@ -198,10 +373,14 @@ INPUT_CSV = "NYC Food Stamp Stores.csv"            # Source CSV to rate
 OUTPUT_CSV = "AI NYC Food Stamp Stores.csv"                 # Destination CSV
 OPENAI_API_KEY = ""                                # Paste your API key here (or leave blank to load from api_key.txt)
 MAX_NUM_STORES = 0                                    # 0 = rate all rows; otherwise only first N rows
-AI_RATE_DELAY = 0.15                                # seconds between API calls
-IS_HEALTHY_BONUS = 2                                # number added to health score if healthy
-IS_GROCERY_BONUS = -1                                # number added to health score if grocery
-IS_RESTAURANT_BONUS = 0                                # number added to health score if restaurant
+AI_CONCURRENCY = 50                                 # max simultaneous API calls
+AI_BATCH_SIZE = 20                                  # stores rated per API call
+AI_RPM = 500                                        # requests-per-minute budget
+AI_TPM = 200_000                                    # tokens-per-minute budget
+AI_CACHE_JSON = "ai_cache.json"                     # disk cache of ratings keyed by (name, store type)
+AI_FLUSH_EVERY = 200                                # checkpoint the output CSV after this many rated stores
+AI_WORKERS = 0                                      # rating worker processes; 0 = one per CPU core
+# Score bonuses (IS_HEALTHY_BONUS etc.) live in ai_rating_core.py
 
 
 if not OPENAI_API_KEY:
@@ -213,28 +392,40 @@ if not OPENAI_API_KEY:
 
 print(f"Started AI Rating")
 
-df = pd.read_csv(INPUT_CSV, dtype=str, keep_default_na=True, low_memory=False)
+# Resume from the output CSV if a previous run already rated part of it;
+# rows with a valid score are skipped so no OpenAI tokens are re-spent
+# The pyarrow engine parses multi-threaded and is noticeably faster than the
+# C engine on the full dataset; dtype=str keeps ZIP codes and IDs as text
+if os.path.exists(OUTPUT_CSV):
+    print(f"Resuming from existing output: {OUTPUT_CSV}")
+    df = pd.read_csv(OUTPUT_CSV, dtype=str, keep_default_na=True, engine="pyarrow")
+else:
+    df = pd.read_csv(INPUT_CSV, dtype=str, keep_default_na=True, engine="pyarrow")
 rated = rate_stores_with_ai(
     df,
     OPENAI_API_KEY,
-    delay_seconds=AI_RATE_DELAY,
+    concurrency=AI_CONCURRENCY,
+    batch_size=AI_BATCH_SIZE,
+    rpm=AI_RPM,
+    tpm=AI_TPM,
     limit=(MAX_NUM_STORES or None),
+    cache_path=AI_CACHE_JSON,
+    output_csv=OUTPUT_CSV,
+    flush_every=AI_FLUSH_EVERY,
+    workers=AI_WORKERS,
 )
 
-# Ensure all required columns exist
+# Ensure all required columns exist; scores are nullable Int8 so unrated rows
+# are written as blank cells instead of a fake score of 0
 if "AI_Health_Score" not in rated.columns:
-    rated["AI_Health_Score"] = np.nan
+    rated["AI_Health_Score"] = pd.Series(pd.NA, index=rated.index, dtype="Int8")
 if "AI_Health_Reason" not in rated.columns:
     rated["AI_Health_Reason"] = ""
 if "AI_Economy_Score" not in rated.columns:
-    rated["AI_Economy_Score"] = np.nan
+    rated["AI_Economy_Score"] = pd.Series(pd.NA, index=rated.index, dtype="Int8")
 if "AI_Economy_Reason" not in rated.columns:
     rated["AI_Economy_Reason"] = ""
 
-# Cast score columns to integers, handling NaN values
-rated["AI_Health_Score"] = pd.to_numeric(rated["AI_Health_Score"], errors='coerce').fillna(0).astype(int)
-rated["AI_Economy_Score"] = pd.to_numeric(rated["AI_Economy_Score"], errors='coerce').fillna(0).astype(int)
-
 rated.to_csv(OUTPUT_CSV, index=False)
 print(f"Wrote AI ratings to: {OUTPUT_CSV}")
 
@@ -0,0 +1,66 @@
+import httpx
+import orjson
+
+
+OPENAI_CHAT_URL = "https://api.openai.com/v1/chat/completions"
+
+# Score bonuses applied on top of the model's raw ratings
+IS_HEALTHY_BONUS = 2                                # number added to health score if healthy
+IS_GROCERY_BONUS = -1                               # number added to health score if grocery
+IS_RESTAURANT_BONUS = 0                             # number added to health score if restaurant
+
+def openai_headers(api_key: str) -> dict:
+    # Built once per run and attached to the shared session, so requests
+    # don't rebuild the dict per call
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {api_key}",
+    }
+
+
+async def _openai_chat_json(client: httpx.AsyncClient, system_prompt: str, user_prompt: str) -> dict:
+    data = {
+        "model": "gpt-4o-mini",
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt},
+        ],
+        "temperature": 0.2,
+        # JSON mode: the model is constrained to emit a single valid JSON
+        # object, so no regex fallback is needed on the content
+        "response_format": {"type": "json_object"},
+    }
+    try:
+        resp = await client.post(OPENAI_CHAT_URL, content=orjson.dumps(data))
+        # Keep the body as bytes: orjson parses them directly, so the
+        # response is only decoded to text on the error path
+        body = resp.content
+        if resp.status_code >= 400:
+            err = RuntimeError(f"OpenAI HTTP error: {resp.status_code} {body.decode('utf-8', 'replace')}")
+            err.status = resp.status_code
+            raise err
+    except httpx.TimeoutException:
+        raise RuntimeError("OpenAI request timed out")
+    except RuntimeError:
+        raise
+    except Exception as e:
+        raise RuntimeError(f"OpenAI request failed: {e}")
+
+    try:
+        j = orjson.loads(body)
+        content = j.get("choices", [{}])[0].get("message", {}).get("content", "")
+        return orjson.loads(content)
+    except Exception:
+        return {}
+
+
+def _parse_bool(value) -> bool:
+    try:
+        if value is None:
+            return False
+        if isinstance(value, (int, float)):
+            return bool(int(value))
+        s = str(value).strip().lower()
+        return s in {"1", "true", "yes", "y", "t"}
+    except Exception:
+        return False